@@ -0,0 +1,37 @@
+import os
+import multiprocessing
+
+# Cấu hình gunicorn: gunicorn -c gunicorn.conf.py app:app
+#
+# GUNICORN_PROFILE=sync  (mặc định) - worker đồng bộ, mỗi request giữ một worker
+# GUNICORN_PROFILE=gevent           - worker gevent cho các route chờ I/O
+#   (/map/wms, /map/wfs, geocoding): một worker giữ được hàng trăm request
+#   upstream đang chờ; psycopg2 được patch bằng psycogreen để truy vấn DB
+#   cũng nhường CPU thay vì chặn cả worker.
+PROFILE = os.getenv('GUNICORN_PROFILE', 'sync')
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+
+if PROFILE == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() + 1))
+else:
+    worker_class = 'sync'
+
+
+def post_fork(server, worker):
+    # Không import module của ứng dụng ở đây: chưa load_dotenv() và (gevent)
+    # chưa monkey.patch_all()
+    if PROFILE == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    # Chạy sau khi worker đã load ứng dụng (có hay không --preload)
+    from src.utils import change_feed
+    if change_feed.CHANGE_FEED_ENABLED:
+        change_feed.start_listener()
@@ -0,0 +1,88 @@
+"""Load test cho proxy /map/wms với GeoServer giả lập.
+
+1. Chạy GeoServer giả (trả PNG sau một độ trễ cố định):
+       python scripts/bench_proxy.py stub --port 8600 --delay 0.2
+2. Chạy API trỏ vào GeoServer giả, lần lượt với từng profile:
+       GEOSERVER_URL=http://127.0.0.1:8600 GUNICORN_WORKERS=1 \\
+       GUNICORN_PROFILE=sync gunicorn -c gunicorn.conf.py app:app
+       GEOSERVER_URL=http://127.0.0.1:8600 GUNICORN_WORKERS=1 \\
+       GUNICORN_PROFILE=gevent gunicorn -c gunicorn.conf.py app:app
+3. Bắn tải và so sánh thông lượng:
+       python scripts/bench_proxy.py load --url http://127.0.0.1:5000/map/wms/ -n 300 -c 100
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# PNG 1x1 trong suốt
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082'
+)
+
+
+def run_stub(port, delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(PNG)))
+            self.end_headers()
+            self.wfile.write(PNG)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print(f"GeoServer giả lập tại http://127.0.0.1:{port} (delay={delay}s)")
+    server.serve_forever()
+
+
+def run_load(url, total, concurrency):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    params = {'bbox': '11770000,2420000,11780000,2430000', 'layer': 'health_map:access_health'}
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            status = session.get(url, params=params, timeout=60).status_code
+        except requests.RequestException:
+            # Worker đồng bộ quá tải có thể reset kết nối: tính là lỗi
+            status = None
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    ok = sum(1 for status, _ in results if status == 200)
+    latencies = sorted(lat for _, lat in results)
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{ok}/{total} OK trong {elapsed:.2f}s -> {total / elapsed:.1f} req/s "
+          f"(p50={p50 * 1000:.0f}ms, p95={p95 * 1000:.0f}ms)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    stub = sub.add_parser('stub')
+    stub.add_argument('--port', type=int, default=8600)
+    stub.add_argument('--delay', type=float, default=0.2)
+    load = sub.add_parser('load')
+    load.add_argument('--url', default='http://127.0.0.1:5000/map/wms/')
+    load.add_argument('-n', type=int, default=300)
+    load.add_argument('-c', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.cmd == 'stub':
+        run_stub(args.port, args.delay)
+    else:
+        run_load(args.url, args.n, args.c)
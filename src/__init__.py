@@ -8,6 +8,10 @@ def create_app():
      # Khởi tạo ứng dụng Flask
      app = Flask(__name__)
 
+     # Read-your-writes: client vừa ghi sẽ đọc từ primary trong một khoảng ngắn
+     from .utils.db_utils import set_read_your_writes_cookie
+     app.after_request(set_read_your_writes_cookie)
+
      # Đăng ký các blueprint cho các module API
 
      from .api.analysis import analysis_bp
@@ -22,6 +26,28 @@ def create_app():
      from .api.wms import wms_bp
      app.register_blueprint(wms_bp, url_prefix='/map/wms')
 
+     # Change feed (LISTEN/NOTIFY) để hủy cache khi access_health / road_hn thay đổi
+     from .utils import change_feed
+
+     @app.cli.command('install-change-feed')
+     def install_change_feed():
+          change_feed.install_triggers()
+          print("Đã cài đặt trigger NOTIFY cho access_health và road_hn")
+
+     @app.cli.command('refresh-population-nodes')
+     def refresh_population_nodes():
+          from .utils import coverage
+          if coverage.refresh_population_nodes():
+               print("Đã làm mới population_road_nodes")
+          else:
+               print("Đang có tiến trình khác làm mới population_road_nodes")
+
+     # Khởi động listener ở request đầu tiên của mỗi worker, không khởi động trong
+     # create_app (với --preload, create_app chạy trong gunicorn master)
+     if change_feed.CHANGE_FEED_ENABLED:
+          @app.before_request
+          def ensure_change_listener():
+               change_feed.start_listener()
 
      # Trả về ứng dụng Flask đã được cấu hình
      return app
@@ -1,11 +1,20 @@
 import logging
+import numpy as np
 from flask import json, jsonify, request
+from psycopg2.errors import QueryCanceled, UndefinedTable
 from src.utils.db_utils import *
+from src.utils.admission import DeadlineExceeded, admission_guard, current_deadline, execute, timeout_response, stats
+from src.utils import coverage
 from . import analysis_bp
 
 logger = logging.getLogger(__name__)
 
+@analysis_bp.route('/admission_stats', methods=['GET'])
+def admission_stats():
+    return jsonify(stats())
+
 @analysis_bp.route('/nearest_facilities', methods=['GET'])
+@admission_guard('nearest_facilities', max_concurrent=16, timeout_s=5)
 def nearest_facilities():
     conn = None
     try:
@@ -20,11 +29,11 @@ def nearest_facilities():
         # viết thường
         facility_type = facility_type.lower()
         
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
 
         # Tìm đỉnh gần nhất với vị trí người dùng
-        cur.execute("""
+        execute(cur, """
             SELECT gid, source
             FROM road_hn
             ORDER BY geom <-> ST_SetSRID(ST_MakePoint(%s, %s), 4326)
@@ -36,7 +45,7 @@ def nearest_facilities():
         user_node = user_node_row[1]
 
         # Lấy danh sách 5 cơ sở y tế gần nhất
-        cur.execute("""
+        execute(cur, """
             SELECT a.id, a.name, a.amenity,ST_AsGeoJSON(a.geometry)::json AS geometry, r.source AS node_id
             FROM access_health a
             JOIN LATERAL (
@@ -67,6 +76,8 @@ def nearest_facilities():
 
         return jsonify(facilities)
 
+    except (QueryCanceled, DeadlineExceeded):
+        return timeout_response()
     except Exception as e:
         logger.error(f"Lỗi tìm kiếm cơ sở y tế gần nhất: {e}", exc_info=True)
         return jsonify({"error": "Lỗi nội bộ", "details": str(e)}), 500
@@ -75,6 +86,7 @@ def nearest_facilities():
             conn.close()
 
 @analysis_bp.route('/shortest_path', methods=['GET'])
+@admission_guard('shortest_path', max_concurrent=4, timeout_s=15, retry_after=5, shared=True)
 def shortest_path_to_facility():
     conn = None
     try:
@@ -85,11 +97,11 @@ def shortest_path_to_facility():
         if not lat or not lon or not name:
             return jsonify({"error": "Thiếu tham số tọa độ (lat, lon) hoặc tên cơ sở y tế"}), 400
 
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
 
         # Tìm đỉnh gần nhất với vị trí người dùng
-        cur.execute("""
+        execute(cur, """
             SELECT gid, source, target
             FROM road_hn
             ORDER BY geom <-> ST_SetSRID(ST_MakePoint(%s, %s), 4326)
@@ -101,7 +113,7 @@ def shortest_path_to_facility():
         user_node = user_node_row[1]
 
         # Lấy thông tin của cơ sở y tế gần nhất theo tên
-        cur.execute("""
+        execute(cur, """
             SELECT a.id, a.name, a.amenity, a.geometry, r.source AS node_id
             FROM access_health a
             JOIN LATERAL (
@@ -120,7 +132,7 @@ def shortest_path_to_facility():
         facility_id, facility_name, facility_type, facility_geom, facility_node = facility_row
 
         # Tính toán đường đi ngắn nhất bằng pgr_dijkstra
-        cur.execute("""
+        execute(cur, """
             SELECT edge
             FROM pgr_dijkstra(
                 'SELECT gid AS id, source, target, cost FROM road_hn',
@@ -132,7 +144,7 @@ def shortest_path_to_facility():
             return jsonify({"error": "Không tìm thấy tuyến đường đến cơ sở y tế"}), 404
 
         # Tính tổng chi phí quãng đường
-        cur.execute("""
+        execute(cur, """
             SELECT SUM(cost) 
             FROM road_hn 
             WHERE gid IN ({})
@@ -140,7 +152,7 @@ def shortest_path_to_facility():
         cost = cur.fetchone()[0]
 
         # Truy xuất tuyến đường dưới dạng GeoJSON
-        cur.execute("""
+        execute(cur, """
             SELECT ST_AsGeoJSON(ST_Union(geom)) 
             FROM road_hn 
             WHERE gid IN ({})
@@ -148,7 +160,7 @@ def shortest_path_to_facility():
         route_geojson = cur.fetchone()[0]
 
         # Lấy tọa độ của cơ sở y tế
-        cur.execute("""
+        execute(cur, """
             SELECT ST_X(ST_Centroid(geometry)), ST_Y(ST_Centroid(geometry))
             FROM access_health
             WHERE id = %s
@@ -169,6 +181,8 @@ def shortest_path_to_facility():
             }
         })
 
+    except (QueryCanceled, DeadlineExceeded):
+        return timeout_response()
     except Exception as e:
         logger.error(f"Lỗi tính toán đường đi ngắn nhất: {e}", exc_info=True)
         return jsonify({"error": "Lỗi nội bộ", "details": str(e)}), 500
@@ -178,6 +192,7 @@ def shortest_path_to_facility():
 
 
 @analysis_bp.route('/buffer', methods=['GET'])
+@admission_guard('buffer', max_concurrent=8, timeout_s=10, retry_after=2)
 def population_in_buffer():
     osm_id = request.args.get('id')
     try:
@@ -194,16 +209,19 @@ def population_in_buffer():
         WHERE ST_DWithin(population_points.geom::geography, access_health.geometry::geography, %s)
     """
 
+    conn = None
     try:
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
-        cur.execute(sql, (osm_id, radius))
+        execute(cur, sql, (osm_id, radius))
         row = cur.fetchone()
         
         if not row:
             return jsonify({"message": f"No population data found for facility with id {osm_id}"}), 404
         return jsonify({"osm_id": osm_id, "total_population": row[0]})
     
+    except (QueryCanceled, DeadlineExceeded):
+        return timeout_response()
     except Exception as e:
         logger.error(f"Population buffer error: {e}", exc_info=True)
         return jsonify({"error": "Failed to calculate population", "details": str(e)}), 500
@@ -213,6 +231,7 @@ def population_in_buffer():
 
 
 @analysis_bp.route('/population_stats_by_distance', methods=['GET'])
+@admission_guard('population_stats_by_distance', max_concurrent=2, timeout_s=60, retry_after=30, shared=True)
 def population_stats():
     ftype = request.args.get('type')
     where = "WHERE access_health.amenity = %s" if ftype else ""
@@ -241,10 +260,11 @@ def population_stats():
         ORDER BY distance_bin;
     """
 
+    conn = None
     try:
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
-        cur.execute(sql.format(where=where), params)
+        execute(cur, sql.format(where=where), params)
         rows = cur.fetchall()
         
         print(rows)
@@ -255,6 +275,87 @@ def population_stats():
         return jsonify([
             {"distance_bin": b, "total_population": result.get(b, 0)} for b in bins
         ])
+    except (QueryCanceled, DeadlineExceeded):
+        return timeout_response()
     except Exception as e:
         logger.error(f"Population stats error: {e}", exc_info=True)
         return jsonify({"error": "Failed to calculate stats", "details": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+
+@analysis_bp.route('/coverage_gaps', methods=['GET'])
+@admission_guard('coverage_gaps', max_concurrent=1, timeout_s=120, retry_after=60, shared=True)
+def coverage_gaps():
+    facility_type = request.args.get('type')
+    try:
+        max_cost = float(request.args.get('max_cost', 3000))
+        k = int(request.args.get('k', 5))
+        n_candidates = int(request.args.get('candidates', 200))
+        if not facility_type or max_cost <= 0 or k <= 0 or not 0 < n_candidates <= 500:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "Invalid 'type', 'max_cost', 'k' or 'candidates' (1-500)"}), 400
+
+    conn = None
+    try:
+        nodes, population = coverage.population_nodes()
+
+        conn = create_connection(readonly=True)
+        cur = conn.cursor()
+
+        # Đỉnh nằm trong ngưỡng chi phí từ bất kỳ cơ sở nào cùng loại
+        served = coverage.covered_nodes(cur, coverage.facility_nodes(cur, facility_type), max_cost)
+        gap_mask = ~np.isin(nodes, served)
+        gap_nodes, gap_population = nodes[gap_mask], population[gap_mask]
+
+        # Ứng viên: các đỉnh thiếu dịch vụ đông dân nhất
+        top = np.argsort(gap_population)[::-1][:n_candidates]
+        candidates = gap_nodes[top].tolist()
+        reach_starts, reach_nodes = coverage.candidate_reach(candidates, max_cost, deadline=current_deadline(),
+                                                            pinned=pinned_to_primary())
+        selected = coverage.greedy_max_coverage(candidates, reach_starts, reach_nodes, gap_nodes, gap_population, k)
+
+        top_gaps = top[:50]
+        coords = coverage.node_coordinates(cur, [candidates[i] for i, _ in selected] + gap_nodes[top_gaps].tolist())
+
+        total_population = float(population.sum())
+        uncovered_population = float(gap_population.sum())
+        sites = []
+        added_total = 0.0
+        for i, added in selected:
+            added_total += added
+            sites.append({
+                "node_id": candidates[i],
+                "coordinates": coords.get(candidates[i]),
+                "added_population": round(added),
+                "cumulative_covered_population": round(total_population - uncovered_population + added_total),
+            })
+
+        return jsonify({
+            "type": facility_type,
+            "max_cost": max_cost,
+            "total_population": round(total_population),
+            "covered_population": round(total_population - uncovered_population),
+            "uncovered_population": round(uncovered_population),
+            "gaps": [
+                {
+                    "node_id": int(gap_nodes[i]),
+                    "coordinates": coords.get(int(gap_nodes[i])),
+                    "population": round(float(gap_population[i])),
+                } for i in top_gaps
+            ],
+            "proposed_sites": sites,
+        })
+    except (QueryCanceled, DeadlineExceeded):
+        return timeout_response()
+    except UndefinedTable as e:
+        logger.error(f"Coverage gap error: {e}", exc_info=True)
+        return jsonify({"error": "Chưa có dữ liệu population_road_nodes, chạy 'flask refresh-population-nodes'"}), 503
+    except Exception as e:
+        logger.error(f"Coverage gap error: {e}", exc_info=True)
+        return jsonify({"error": "Failed to calculate coverage gaps", "details": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
@@ -3,14 +3,31 @@ from flask import jsonify, request
 from . import data_bp
 
 from src.utils.db_utils import *
+from src.utils.http_cache import compress_response, conditional
 
 logger = logging.getLogger(__name__)
 
+# Ánh xạ loại cơ sở y tế trên URL sang giá trị amenity trong DB
+FACILITY_TYPES = {
+    "hospital": "bệnh viện",
+    "pharmacy": "nhà thuốc",
+    "doctor": "phòng khám tư nhân",
+    "clinic": "trạm y tế/phòng khám",
+    "dentist": "nha khoa",
+    "alternative": "y học cổ truyền",
+    "blood_donation": "trung tâm hiến máu",
+    "vacxin": "trung tâm tiêm vacxin",
+}
+
+# Nén gzip/brotli các body JSON lớn
+data_bp.after_request(compress_response)
+
 # lấy tất cả các cơ sở y tế từ DB
 @data_bp.route('/facilities', methods=['GET'])
+@conditional('access_health')
 def get_facilities_data():
     try:
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
         
         sql = """SELECT * FROM access_health"""
@@ -48,28 +65,14 @@ def get_facilities_data():
             
 # lấy theo loại cơ sở y tế
 @data_bp.route('/facilities/<facility_type>', methods=['GET'])
+@conditional('access_health', amenity_of=lambda facility_type: FACILITY_TYPES.get(facility_type, facility_type))
 def get_facility_by_type(facility_type):
     try:
         if(not facility_type):
             return jsonify({"error": "Invalid or missing 'facility_type' parameter"}), 400
-        elif(facility_type == "hospital"):
-            facility_type = "bệnh viện"
-        elif(facility_type == "pharmacy"):
-            facility_type = "nhà thuốc"
-        elif(facility_type == "doctor"):
-            facility_type = "phòng khám tư nhân"
-        elif(facility_type == "clinic"):
-            facility_type = "trạm y tế/phòng khám"
-        elif(facility_type == "dentist"):
-            facility_type = "nha khoa"
-        elif(facility_type == "alternative"):
-            facility_type = "y học cổ truyền"
-        elif(facility_type == "blood_donation"):
-            facility_type = "trung tâm hiến máu"
-        elif(facility_type == "vacxin"):
-            facility_type = "trung tâm tiêm vacxin"
+        facility_type = FACILITY_TYPES.get(facility_type, facility_type)
         
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
         
         sql = """SELECT * FROM access_health WHERE amenity = %s"""
@@ -107,13 +110,14 @@ def get_facility_by_type(facility_type):
 
 # tìm cơ sở y tế theo tên
 @data_bp.route('/facilities/search', methods=['GET'])
+@conditional('access_health', required_args=('name',))
 def search_facility_by_name():
     name = request.args.get('name')
     if not name:
         return jsonify({"error": "Invalid or missing 'name' parameter"}), 400
 
     try:
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
         
         sql = """SELECT * FROM access_health WHERE name ILIKE %s"""
@@ -151,10 +155,11 @@ def search_facility_by_name():
             
 # lấy riêng một cơ sở y tế theo id
 @data_bp.route('/facility', methods=['GET'])
+@conditional('access_health', required_args=('id',))
 def get_facility_by_id():
     try:
         facility_id = request.args.get('id')
-        conn = create_connection()
+        conn = create_connection(readonly=True)
         cur = conn.cursor()
         
         sql = """SELECT * FROM access_health WHERE id = %s"""
@@ -237,6 +242,7 @@ def create_facility():
         ))
 
         conn.commit()
+        mark_write()
         return jsonify({"message": "Facility added successfully"}), 201
 
     except Exception as e:
@@ -319,6 +325,7 @@ def update_facility():
 
         cur.execute(sql, params)
         conn.commit()
+        mark_write()
 
         return jsonify({"message": "Facility updated successfully"})
 
@@ -344,6 +351,7 @@ def delete_facility(facility_id):
         # Xóa cơ sở y tế
         cur.execute("DELETE FROM access_health WHERE id = %s", (facility_id,))
         conn.commit()
+        mark_write()
 
         return jsonify({"message": "Facility deleted successfully"})
 
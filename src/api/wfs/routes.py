@@ -1,7 +1,7 @@
-import requests
 from flask import jsonify, request
 from . import wfs_bp
 from ...utils.db_utils import *
+from ...utils import http_client
 
 GEOSERVER_WFS_URL = os.getenv('GEOSERVER_URL') + '/wfs'
 
@@ -20,7 +20,7 @@ def get_wfs_layer():
     }
     
     try:
-        response = requests.get(GEOSERVER_WFS_URL, params=params)
+        response = http_client.get(GEOSERVER_WFS_URL, params=params)
         
         if response.status_code == 200:
             return jsonify(response.json())
@@ -1,9 +1,9 @@
 import os
-import requests
 from flask import request, Response
 
 from . import wms_bp
 from ...utils.db_utils import *
+from ...utils import http_client
 
 GEOSERVER_WMS_URL = os.getenv('GEOSERVER_URL') + '/health_map/wms'
 
@@ -33,7 +33,7 @@ def get_wms_map():
     }
 
     try:
-        response = requests.get(GEOSERVER_WMS_URL, params=params, stream=True)
+        response = http_client.get(GEOSERVER_WMS_URL, params=params)
         
         if response.status_code == 200:
             return Response(response.content, content_type=response.headers['Content-Type'])
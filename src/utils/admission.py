@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+import zlib
+from functools import wraps
+
+from flask import g, has_request_context, jsonify
+
+from .db_utils import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Giới hạn tải cho các route phân tích nặng: mỗi endpoint có một semaphore
+# riêng, một hạn chót (deadline) cho request được truyền xuống statement_timeout
+# của PostgreSQL trước mỗi câu lệnh (execute). Khi đầy thì trả 503 + Retry-After ngay thay vì xếp hàng vô hạn.
+#
+# Semaphore và bộ đếm tồn tại theo từng process gunicorn: mặc định max_concurrent
+# là giới hạn cho MỖI worker. Với shared=True, giới hạn áp cho toàn bộ worker bằng
+# max_concurrent "slot" advisory lock trên primary (pg_try_advisory_lock); kết nối
+# giữ khóa được đóng khi request kết thúc (hoặc worker chết) nên slot tự nhả.
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+class _RouteGuard:
+    def __init__(self, name, max_concurrent, timeout_s, queue_wait_s, retry_after, shared):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.shared = shared
+        self.lock_key = zlib.crc32(name.encode()) & 0x7fffffff
+        self.timeout_s = timeout_s
+        self.queue_wait_s = queue_wait_s
+        self.retry_after = retry_after
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.counters = {"admitted": 0, "rejected": 0, "timed_out": 0, "in_flight": 0}
+
+    def acquire_shared_slot(self):
+        # Trả về kết nối đang giữ một slot, hoặc None nếu mọi slot đã bị giữ
+        conn = create_connection()
+        conn.autocommit = True
+        cur = conn.cursor()
+        for slot in range(self.max_concurrent):
+            cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (self.lock_key, slot))
+            if cur.fetchone()[0]:
+                return conn
+        conn.close()
+        return None
+
+    def count(self, key, delta=1):
+        with self.lock:
+            self.counters[key] += delta
+
+
+def _error_response(message, retry_after):
+    response = jsonify({"error": message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def admission_guard(name, max_concurrent, timeout_s, queue_wait_s=0.0, retry_after=1, shared=False):
+    guard = _RouteGuard(name, max_concurrent, timeout_s, queue_wait_s, retry_after, shared)
+    with _guards_lock:
+        _guards[name] = guard
+
+    def reject():
+        guard.count("rejected")
+        logger.warning(f"Admission rejected: {name} (max {guard.max_concurrent})")
+        return _error_response("Máy chủ đang quá tải, vui lòng thử lại sau", guard.retry_after)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Semaphore cục bộ trước: worker đã đầy thì không cần mở kết nối tới DB
+            if guard.queue_wait_s:
+                acquired = guard.semaphore.acquire(timeout=guard.queue_wait_s)
+            else:
+                acquired = guard.semaphore.acquire(blocking=False)
+            if not acquired:
+                return reject()
+
+            slot_conn = None
+            try:
+                if guard.shared:
+                    try:
+                        slot_conn = guard.acquire_shared_slot()
+                    except Exception as e:
+                        logger.error(f"Admission slot error: {name}: {e}", exc_info=True)
+                    if slot_conn is None:
+                        return reject()
+
+                guard.count("admitted")
+                guard.count("in_flight")
+                g.admission_route = name
+                g.deadline = time.monotonic() + guard.timeout_s
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    guard.count("in_flight", -1)
+            finally:
+                if slot_conn is not None:
+                    slot_conn.close()
+                guard.semaphore.release()
+        return wrapper
+    return decorator
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def current_deadline():
+    # Deadline của request hiện tại (time.monotonic()); truyền tường minh cho
+    # các luồng phụ vì chúng không có request context
+    return g.get('deadline') if has_request_context() else None
+
+
+def remaining_ms(deadline=None):
+    # Thời gian còn lại trước deadline (ms), có thể <= 0 nếu đã quá hạn
+    if deadline is None:
+        deadline = current_deadline()
+    if deadline is None:
+        return None
+    return int((deadline - time.monotonic()) * 1000)
+
+
+def execute(cur, sql, params=None, deadline=None):
+    # Mọi truy vấn trong route có guard đi qua đây: statement_timeout được đặt
+    # lại bằng thời gian còn lại của request trước mỗi câu lệnh, nên tổng thời
+    # gian các câu lệnh không vượt quá deadline.
+    ms = remaining_ms(deadline)
+    if ms is not None:
+        if ms <= 0:
+            raise DeadlineExceeded()
+        cur.execute("SET statement_timeout = %s", (ms,))
+    cur.execute(sql, params)
+
+
+def timeout_response():
+    # Gọi khi truy vấn bị hủy bởi statement_timeout (psycopg2.errors.QueryCanceled)
+    # hoặc request đã quá deadline trước câu lệnh kế tiếp (DeadlineExceeded)
+    name = g.get('admission_route')
+    guard = _guards.get(name)
+    retry_after = 1
+    if guard:
+        guard.count("timed_out")
+        retry_after = guard.retry_after
+    logger.warning(f"Request timed out: {name}")
+    return _error_response("Truy vấn vượt quá thời gian cho phép", retry_after)
+
+
+def _shared_in_flight(guards):
+    # Số slot đang bị giữ trên toàn bộ worker (đếm advisory lock trong pg_locks)
+    keys = [guard.lock_key for guard in guards if guard.shared]
+    if not keys:
+        return {}
+    conn = create_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT classid::bigint, count(*)
+            FROM pg_locks
+            WHERE locktype = 'advisory' AND objsubid = 2 AND granted
+              AND classid::bigint = ANY(%s)
+            GROUP BY classid
+        """, (keys,))
+        return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def stats():
+    # Bộ đếm là của worker trả lời request này (pid); với route shared,
+    # global_in_flight là số slot đang dùng trên mọi worker.
+    with _guards_lock:
+        guards = list(_guards.values())
+    try:
+        shared_in_flight = _shared_in_flight(guards)
+    except Exception as e:
+        logger.error(f"Admission stats error: {e}", exc_info=True)
+        shared_in_flight = None
+    result = {}
+    for guard in guards:
+        with guard.lock:
+            result[guard.name] = {
+                **guard.counters,
+                "max_concurrent": guard.max_concurrent,
+                "scope": "global" if guard.shared else "per_worker",
+                "timeout_s": guard.timeout_s,
+            }
+        if guard.shared and shared_in_flight is not None:
+            result[guard.name]["global_in_flight"] = shared_in_flight.get(guard.lock_key, 0)
+    return {"pid": os.getpid(), "routes": result}
@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2.extensions
+
+from .db_utils import create_connection
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED_CHANNEL = os.getenv('CHANGE_FEED_CHANNEL', 'urban_health_changes')
+CHANGE_FEED_ENABLED = os.getenv('CHANGE_FEED_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# Trigger gửi NOTIFY khi access_health / road_hn thay đổi.
+# notify_urban_health_change (theo dòng) - TG_ARGV[0]: cột id, TG_ARGV[1]: cột hình học, TG_ARGV[2..]: các cột bổ sung
+# (giá trị cũ và mới) để phía listener có thể hủy cache theo khóa.
+# TG_ARGV[2] đồng thời là khóa version: trigger tăng data_versions của bảng và của
+# giá trị cũ/mới trong cùng transaction và gửi version mới trong payload, nên mọi
+# worker dùng chung một version (ETag) thay vì tự đếm.
+TRIGGER_SQL = """
+CREATE TABLE IF NOT EXISTS data_versions (
+    table_name  text NOT NULL,
+    amenity     text NOT NULL DEFAULT '',
+    version     bigint NOT NULL DEFAULT 0,
+    modified_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, amenity)
+);
+
+-- modified_at tăng ít nhất 1 giây mỗi lần để If-Modified-Since (độ chính xác giây)
+-- không coi hai thay đổi trong cùng một giây là chưa đổi
+CREATE OR REPLACE FUNCTION bump_data_version(t text, a text) RETURNS json AS $$
+    INSERT INTO data_versions AS d (table_name, amenity, version, modified_at)
+    VALUES (t, a, 1, date_trunc('second', clock_timestamp()))
+    ON CONFLICT (table_name, amenity) DO UPDATE
+        SET version = d.version + 1,
+            modified_at = GREATEST(date_trunc('second', clock_timestamp()), d.modified_at + interval '1 second')
+    RETURNING json_build_array(d.amenity, d.version, extract(epoch FROM d.modified_at));
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION notify_urban_health_change() RETURNS trigger AS $$
+DECLARE
+    id_col   text := TG_ARGV[0];
+    geom_col text := TG_ARGV[1];
+    old_row  jsonb := CASE WHEN TG_OP <> 'INSERT' THEN to_jsonb(OLD) END;
+    new_row  jsonb := CASE WHEN TG_OP <> 'DELETE' THEN to_jsonb(NEW) END;
+    old_geom geometry;
+    new_geom geometry;
+    env      geometry;
+    ids      jsonb := '[]'::jsonb;
+    attrs    jsonb := '{{}}'::jsonb;
+    versions jsonb;
+    old_key  text;
+    new_key  text;
+    i        int;
+BEGIN
+    IF old_row IS NOT NULL THEN
+        ids := ids || jsonb_build_array(old_row -> id_col);
+        EXECUTE format('SELECT ($1).%I::geometry', geom_col) INTO old_geom USING OLD;
+    END IF;
+    IF new_row IS NOT NULL THEN
+        IF old_row IS NULL OR (old_row -> id_col) IS DISTINCT FROM (new_row -> id_col) THEN
+            ids := ids || jsonb_build_array(new_row -> id_col);
+        END IF;
+        EXECUTE format('SELECT ($1).%I::geometry', geom_col) INTO new_geom USING NEW;
+    END IF;
+    env := CASE WHEN old_geom IS NULL THEN new_geom
+                WHEN new_geom IS NULL THEN old_geom
+                ELSE ST_Collect(old_geom, new_geom) END;
+    FOR i IN 2 .. TG_NARGS - 1 LOOP
+        attrs := attrs || jsonb_build_object(
+            TG_ARGV[i],
+            jsonb_build_array(old_row -> TG_ARGV[i], new_row -> TG_ARGV[i])
+        );
+    END LOOP;
+    versions := jsonb_build_array(bump_data_version(TG_TABLE_NAME, ''));
+    IF TG_NARGS > 2 THEN
+        old_key := old_row ->> TG_ARGV[2];
+        new_key := new_row ->> TG_ARGV[2];
+        IF old_key IS NOT NULL THEN
+            versions := versions || jsonb_build_array(bump_data_version(TG_TABLE_NAME, old_key));
+        END IF;
+        IF new_key IS NOT NULL AND new_key IS DISTINCT FROM old_key THEN
+            versions := versions || jsonb_build_array(bump_data_version(TG_TABLE_NAME, new_key));
+        END IF;
+    END IF;
+    PERFORM pg_notify('{channel}', json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', TG_OP,
+        'ids', ids,
+        'bbox', CASE WHEN env IS NULL THEN NULL
+                     ELSE json_build_array(ST_XMin(env), ST_YMin(env), ST_XMax(env), ST_YMax(env)) END,
+        'attrs', attrs,
+        'versions', versions
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS access_health_notify ON access_health;
+CREATE TRIGGER access_health_notify
+    AFTER INSERT OR UPDATE OR DELETE ON access_health
+    FOR EACH ROW EXECUTE FUNCTION notify_urban_health_change('id', 'geometry', 'amenity');
+
+-- road_hn thường bị sửa hàng loạt (pgr_createTopology, nhập lại, tính lại cost):
+-- trigger theo câu lệnh, gửi một NOTIFY gộp (số dòng + bbox) thay vì một NOTIFY mỗi dòng.
+-- Transition table chỉ dùng được với trigger một sự kiện -> ba trigger.
+CREATE OR REPLACE FUNCTION notify_road_hn_change() RETURNS trigger AS $$
+DECLARE
+    n   bigint;
+    box box2d;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT count(*), ST_Extent(geom) INTO n, box FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT count(*), ST_Extent(geom) INTO n, box FROM old_rows;
+    ELSE
+        SELECT count(*) INTO n FROM new_rows;
+        SELECT ST_Extent(geom) INTO box
+        FROM (SELECT geom FROM old_rows UNION ALL SELECT geom FROM new_rows) changed;
+    END IF;
+    IF n = 0 THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify('{channel}', json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', TG_OP,
+        'ids', '[]'::json,
+        'count', n,
+        'bbox', CASE WHEN box IS NULL THEN NULL
+                     ELSE json_build_array(ST_XMin(box), ST_YMin(box), ST_XMax(box), ST_YMax(box)) END,
+        'attrs', '{{}}'::json
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS road_hn_notify ON road_hn;
+DROP TRIGGER IF EXISTS road_hn_notify_insert ON road_hn;
+CREATE TRIGGER road_hn_notify_insert
+    AFTER INSERT ON road_hn REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_road_hn_change();
+
+DROP TRIGGER IF EXISTS road_hn_notify_update ON road_hn;
+CREATE TRIGGER road_hn_notify_update
+    AFTER UPDATE ON road_hn REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_road_hn_change();
+
+DROP TRIGGER IF EXISTS road_hn_notify_delete ON road_hn;
+CREATE TRIGGER road_hn_notify_delete
+    AFTER DELETE ON road_hn REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_road_hn_change();
+
+-- TRUNCATE không kích hoạt trigger DELETE: tăng mọi version của bảng và gửi một
+-- NOTIFY "TRUNCATE" để listener xử lý như RESYNC (xóa hết / đọc lại)
+CREATE OR REPLACE FUNCTION notify_truncate() RETURNS trigger AS $$
+BEGIN
+    UPDATE data_versions
+    SET version = version + 1,
+        modified_at = GREATEST(date_trunc('second', clock_timestamp()), modified_at + interval '1 second')
+    WHERE table_name = TG_TABLE_NAME AND amenity <> '';
+    PERFORM bump_data_version(TG_TABLE_NAME, '');
+    PERFORM pg_notify('{channel}', json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', 'TRUNCATE',
+        'ids', '[]'::json,
+        'bbox', NULL,
+        'attrs', '{{}}'::json
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS access_health_notify_truncate ON access_health;
+CREATE TRIGGER access_health_notify_truncate
+    AFTER TRUNCATE ON access_health
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_truncate();
+
+DROP TRIGGER IF EXISTS road_hn_notify_truncate ON road_hn;
+CREATE TRIGGER road_hn_notify_truncate
+    AFTER TRUNCATE ON road_hn
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_truncate();
+"""
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+_listener = None
+_listener_pid = None
+
+
+def install_triggers():
+    # Chạy một lần khi triển khai (hoặc từ shell), không chạy mỗi lần khởi động worker
+    conn = create_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(TRIGGER_SQL.format(channel=CHANGE_FEED_CHANNEL))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def subscribe(table, handler):
+    # handler(event) được gọi trong luồng listener với event là dict:
+    # {"table", "op", "ids", "bbox", "attrs", "versions"} (versions: danh sách
+    # [amenity, version, modified_at] từ data_versions, amenity '' là cả bảng;
+    # road_hn: ids rỗng, thêm "count" vì thông báo gộp theo câu lệnh);
+    # op = "RESYNC" khi mất kết nối và có thể đã bỏ lỡ thông báo, op = "TRUNCATE"
+    # khi bảng bị TRUNCATE -> cả hai: handler nên xóa / đọc lại toàn bộ dữ liệu
+    # của bảng (TRUNCATE là thay đổi thật, RESYNC thì chưa chắc).
+    with _handlers_lock:
+        _handlers.setdefault(table, []).append(handler)
+
+
+def is_running():
+    # Luồng không tồn tại qua fork: listener của process cha không tính
+    return _listener is not None and _listener_pid == os.getpid() and _listener.is_alive()
+
+
+def _dispatch(event):
+    with _handlers_lock:
+        handlers = list(_handlers.get(event.get('table'), []))
+    for handler in handlers:
+        try:
+            handler(event)
+        except Exception as e:
+            logger.error(f"Change feed handler error: {e}", exc_info=True)
+
+
+def _resync_all():
+    with _handlers_lock:
+        tables = list(_handlers)
+    for table in tables:
+        _dispatch({"table": table, "op": "RESYNC", "ids": [], "bbox": None, "attrs": {}})
+
+
+class ChangeListener(threading.Thread):
+    def __init__(self, channel=CHANGE_FEED_CHANNEL, poll_interval=1.0, retry_delay=5.0):
+        super().__init__(name='change-feed-listener', daemon=True)
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = create_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN "{self.channel}";')
+                # Có thể đã bỏ lỡ thay đổi trước khi LISTEN (khởi động / kết nối lại)
+                _resync_all()
+                self._listen(conn)
+            except Exception as e:
+                logger.error(f"Change feed listener error: {e}", exc_info=True)
+                self._stop_event.wait(self.retry_delay)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _listen(self, conn):
+        while not self._stop_event.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    logger.warning(f"Bỏ qua payload không hợp lệ: {notify.payload!r}")
+                    continue
+                _dispatch(event)
+
+
+def start_listener():
+    # Mỗi worker có một luồng listener riêng. Chỉ gọi trong worker (sau fork),
+    # không gọi trong gunicorn master khi --preload: kết nối LISTEN sẽ bị
+    # tất cả worker thừa kế chung.
+    global _listener, _listener_pid
+    if is_running():
+        return _listener
+    with _handlers_lock:
+        if is_running():
+            return _listener
+        _listener = ChangeListener()
+        _listener_pid = os.getpid()
+        _listener.start()
+    return _listener
+
+
+class InvalidatingCache:
+    """Cache trong bộ nhớ, được hủy theo change feed thay vì TTL ngắn.
+
+    `ttl` là lưới an toàn (mặc định None = không hết hạn); khi change feed
+    không chạy thì nên đặt TTL để tránh dữ liệu cũ giữa các worker.
+    """
+
+    def __init__(self, table, ttl=None):
+        self.table = table
+        self.ttl = ttl
+        self._data = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        subscribe(table, self._on_change)
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and (self.ttl is None or now - entry[1] < self.ttl):
+                return entry[0]
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            # Không lưu nếu cache bị hủy trong lúc đang tải (giá trị có thể đã cũ)
+            if generation == self._generation:
+                self._data[key] = (value, now)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def _on_change(self, event):
+        # Mặc định: xóa toàn bộ (kể cả RESYNC/TRUNCATE). Lớp con có thể hủy có chọn
+        # lọc theo ids/bbox/attrs.
+        self.invalidate()
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .admission import execute
+from .change_feed import CHANGE_FEED_CHANNEL, InvalidatingCache, subscribe
+from .db_utils import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Phân tích vùng thiếu dịch vụ y tế và đề xuất vị trí cơ sở mới (maximal coverage).
+# Dân số được gán sẵn vào đỉnh mạng đường road_hn gần nhất (population_road_nodes);
+# phạm vi phục vụ của một đỉnh là tập đỉnh trong ngưỡng chi phí (pgr_drivingDistance).
+# Phần chọn vị trí chạy bằng NumPy trên mảng chỉ số, không lặp Python theo từng
+# điểm dân cư.
+
+COVERAGE_WORKERS = int(os.getenv('COVERAGE_WORKERS', 4))
+CANDIDATE_CHUNK_SIZE = 25
+# Tự làm mới population_road_nodes khi road_hn thay đổi (qua change feed)
+COVERAGE_AUTO_REFRESH = os.getenv('COVERAGE_AUTO_REFRESH', 'true').lower() in ('1', 'true', 'yes')
+# Khóa advisory: chỉ một worker làm mới materialized view tại một thời điểm
+REFRESH_LOCK_ID = 720310
+
+EDGES_SQL = 'SELECT gid AS id, source, target, cost FROM road_hn'
+
+# Gán dân số vào đỉnh road_hn gần nhất (KNN trên toàn thành phố) được tính trước
+# vào materialized view, không tính trong request. Làm mới bằng
+# `flask refresh-population-nodes` hoặc tự động khi road_hn thay đổi.
+POPULATION_NODES_SQL = """
+CREATE MATERIALIZED VIEW population_road_nodes AS
+SELECT r.source AS node, SUM(p.population_count)::float8 AS population
+FROM population_points p
+JOIN LATERAL (
+    SELECT source
+    FROM road_hn
+    ORDER BY road_hn.geom <-> p.geom
+    LIMIT 1
+) r ON true
+WHERE p.population_count > 0
+GROUP BY r.source;
+
+CREATE UNIQUE INDEX population_road_nodes_node ON population_road_nodes (node);
+"""
+
+# Bản sao trong bộ nhớ của view, hủy khi view được làm mới (NOTIFY sau REFRESH).
+# TTL là lưới an toàn khi change feed không chạy.
+_population_cache = InvalidatingCache('population_road_nodes', ttl=3600)
+
+_refresh_lock = threading.Lock()
+_refresh_pending = False
+_refresh_running = False
+
+
+def refresh_population_nodes():
+    # Tạo hoặc làm mới population_road_nodes trên primary. Trả về False nếu một
+    # worker/tiến trình khác đang làm mới.
+    conn = create_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (REFRESH_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return False
+        cur.execute("SELECT 1 FROM pg_matviews WHERE matviewname = 'population_road_nodes'")
+        if cur.fetchone():
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY population_road_nodes")
+        else:
+            cur.execute(POPULATION_NODES_SQL)
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANGE_FEED_CHANNEL, json.dumps({
+            "table": "population_road_nodes", "op": "REFRESH", "ids": [], "bbox": None, "attrs": {},
+        })))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+def _refresh_loop():
+    global _refresh_pending, _refresh_running
+    while True:
+        with _refresh_lock:
+            if not _refresh_pending:
+                _refresh_running = False
+                return
+            _refresh_pending = False
+        try:
+            refresh_population_nodes()
+        except Exception as e:
+            logger.error(f"Population nodes refresh error: {e}", exc_info=True)
+
+
+def _on_road_change(event):
+    # Gộp các thay đổi liên tiếp thành một lần làm mới chạy nền (không chặn luồng listener).
+    # RESYNC chỉ là kết nối lại, không phải thay đổi -> bỏ qua.
+    global _refresh_pending, _refresh_running
+    if not COVERAGE_AUTO_REFRESH or event.get('op') == 'RESYNC':
+        return
+    with _refresh_lock:
+        _refresh_pending = True
+        if _refresh_running:
+            return
+        _refresh_running = True
+    threading.Thread(target=_refresh_loop, name='population-nodes-refresh', daemon=True).start()
+
+
+subscribe('road_hn', _on_road_change)
+
+
+def _load_population_nodes():
+    # Đọc từ primary: cache chỉ bị hủy khi primary đã REFRESH xong, replica có
+    # thể còn giữ bản cũ của view và bản cũ đó sẽ nằm trong cache tới lần hủy sau
+    conn = create_connection()
+    try:
+        cur = conn.cursor()
+        execute(cur, """
+            SELECT node, population
+            FROM population_road_nodes
+            ORDER BY node
+        """)
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+    nodes = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    population = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    return nodes, population
+
+
+def population_nodes():
+    # (nodes, population): nodes tăng dần, population[i] là dân số gán vào nodes[i]
+    return _population_cache.get('population_nodes', _load_population_nodes)
+
+
+def _driving_distance(cur, start_nodes, max_cost, deadline=None):
+    # Trả về (start, node) cho mọi đỉnh trong ngưỡng chi phí từ start_nodes.
+    # Tên cột đỉnh xuất phát khác nhau giữa các phiên bản pgRouting (from_v / start_vid).
+    execute(cur, """
+        SELECT *
+        FROM pgr_drivingDistance(%s, %s::bigint[], %s, directed := false)
+    """, (EDGES_SQL, list(start_nodes), max_cost), deadline=deadline)
+    columns = [desc[0] for desc in cur.description]
+    start_col = columns.index('start_vid') if 'start_vid' in columns else columns.index('from_v')
+    node_col = columns.index('node')
+    rows = cur.fetchall()
+    starts = np.fromiter((row[start_col] for row in rows), dtype=np.int64, count=len(rows))
+    nodes = np.fromiter((row[node_col] for row in rows), dtype=np.int64, count=len(rows))
+    return starts, nodes
+
+
+def facility_nodes(cur, facility_type):
+    execute(cur, """
+        SELECT DISTINCT r.source
+        FROM access_health a
+        JOIN LATERAL (
+            SELECT source
+            FROM road_hn
+            ORDER BY road_hn.geom <-> a.geometry
+            LIMIT 1
+        ) r ON true
+        WHERE a.amenity ILIKE %s
+    """, ('%' + facility_type + '%',))
+    return [row[0] for row in cur.fetchall()]
+
+
+def covered_nodes(cur, start_nodes, max_cost):
+    if not start_nodes:
+        return np.empty(0, dtype=np.int64)
+    _, nodes = _driving_distance(cur, start_nodes, max_cost)
+    return np.unique(nodes)
+
+
+def _candidate_reach_chunk(chunk, max_cost, deadline, pinned):
+    conn = create_connection(readonly=True, pinned=pinned)
+    try:
+        return _driving_distance(conn.cursor(), chunk, max_cost, deadline=deadline)
+    finally:
+        conn.close()
+
+
+def candidate_reach(candidates, max_cost, deadline=None, pinned=False):
+    # Chạy pgr_drivingDistance song song theo từng nhóm ứng viên, mỗi nhóm một kết nối.
+    # Luồng phụ không có request context -> deadline và pinned (read-your-writes)
+    # được lấy ở luồng request và truyền tường minh.
+    chunks = [candidates[i:i + CANDIDATE_CHUNK_SIZE] for i in range(0, len(candidates), CANDIDATE_CHUNK_SIZE)]
+    if not chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=min(COVERAGE_WORKERS, len(chunks))) as pool:
+        results = list(pool.map(lambda c: _candidate_reach_chunk(c, max_cost, deadline, pinned), chunks))
+    starts = np.concatenate([r[0] for r in results])
+    nodes = np.concatenate([r[1] for r in results])
+    return starts, nodes
+
+
+def greedy_max_coverage(candidates, reach_starts, reach_nodes, gap_nodes, gap_population, k):
+    """Chọn tham lam k ứng viên phủ thêm nhiều dân số nhất.
+
+    gap_nodes (tăng dần) / gap_population: các đỉnh chưa được phục vụ và dân số.
+    reach_starts / reach_nodes: cặp (ứng viên, đỉnh trong ngưỡng chi phí).
+    Trả về danh sách (chỉ số ứng viên, dân số phủ thêm).
+    """
+    candidates = np.asarray(candidates, dtype=np.int64)
+    if len(gap_nodes) == 0 or len(candidates) == 0:
+        return []
+
+    # Chỉ giữ cặp có đỉnh nằm trong vùng thiếu, đổi sang chỉ số cột của gap_nodes
+    cols = np.searchsorted(gap_nodes, reach_nodes)
+    cols = np.minimum(cols, len(gap_nodes) - 1)
+    valid = gap_nodes[cols] == reach_nodes
+    order = np.argsort(candidates, kind='stable')
+    rows = order[np.searchsorted(candidates, reach_starts, sorter=order)]
+    rows, cols = rows[valid], cols[valid]
+
+    # Bỏ cặp trùng và sắp theo ứng viên -> mỗi ứng viên là một đoạn liên tiếp
+    # [offsets[i], offsets[i+1]) trong cols
+    pairs = np.unique(rows * len(gap_nodes) + cols)
+    rows, cols = pairs // len(gap_nodes), pairs % len(gap_nodes)
+    counts = np.bincount(rows, minlength=len(candidates))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    non_empty = counts > 0
+
+    weights = gap_population.astype(np.float64).copy()
+    selected = []
+    for _ in range(min(k, len(candidates))):
+        gains = np.zeros(len(candidates))
+        if len(cols):
+            gains[non_empty] = np.add.reduceat(weights[cols], offsets[:-1][non_empty])
+        best = int(np.argmax(gains))
+        if gains[best] <= 0:
+            break
+        selected.append((best, float(gains[best])))
+        weights[cols[offsets[best]:offsets[best + 1]]] = 0
+    return selected
+
+
+def node_coordinates(cur, nodes):
+    if not nodes:
+        return {}
+    execute(cur, """
+        SELECT DISTINCT ON (source) source,
+            ST_X(ST_StartPoint(ST_GeometryN(geom, 1))),
+            ST_Y(ST_StartPoint(ST_GeometryN(geom, 1)))
+        FROM road_hn
+        WHERE source = ANY(%s::bigint[])
+        ORDER BY source
+    """, (list(nodes),))
+    return {row[0]: [row[1], row[2]] for row in cur.fetchall()}
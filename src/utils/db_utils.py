@@ -1,5 +1,12 @@
+import itertools
+import logging
 import os
+import threading
+import time
 import psycopg2
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
 
 # Sử dụng biến môi trường
 DATABASE_HOST = os.getenv('DB_HOST')
@@ -7,8 +14,125 @@ DB_NAME = os.getenv('DB_NAME')
 DB_USERNAME = os.getenv('DB_USERNAME')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 
-def create_connection():
-    conn = psycopg2.connect(host=DATABASE_HOST, dbname=DB_NAME, user=DB_USERNAME, password=DB_PASSWORD)
+# Read replica: danh sách "host" hoặc "host:port", phân tách bằng dấu phẩy
+DB_REPLICA_HOSTS = [h.strip() for h in os.getenv('DB_REPLICA_HOSTS', '').split(',') if h.strip()]
+# Replica lỗi kết nối bị bỏ qua trong khoảng này trước khi thử lại (giây)
+REPLICA_RETRY_SECONDS = float(os.getenv('REPLICA_RETRY_SECONDS', 30))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', 3))
+# Replica trễ hơn ngưỡng này (giây) bị coi như không khỏe; kết quả kiểm tra được
+# giữ REPLICA_LAG_CHECK_SECONDS để không tốn thêm một truy vấn mỗi kết nối
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 10))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', 5))
+# Độ trễ lớn nhất của dữ liệu đọc từ replica: đạt ngưỡng lúc kiểm tra, rồi còn
+# được dùng thêm trong thời gian giữ kết quả kiểm tra
+REPLICA_STALE_SECONDS = REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS
+# Sau khi client ghi, các lần đọc của client đó đi vào primary trong khoảng này (giây).
+# Ngắn hơn REPLICA_STALE_SECONDS thì client có thể đọc lại dữ liệu cũ từ replica.
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', REPLICA_STALE_SECONDS))
+if READ_YOUR_WRITES_SECONDS < REPLICA_STALE_SECONDS:
+    logger.warning(f"READ_YOUR_WRITES_SECONDS={READ_YOUR_WRITES_SECONDS} is shorter than the replica "
+                   f"staleness bound ({REPLICA_STALE_SECONDS}s), using {REPLICA_STALE_SECONDS}")
+    READ_YOUR_WRITES_SECONDS = REPLICA_STALE_SECONDS
+PRIMARY_COOKIE = 'db_primary_until'
+
+_replica_cycle = itertools.count()
+_replica_down_until = {}
+_replica_lag_ok_until = {}
+_replica_lock = threading.Lock()
+
+def _connect(host, **kwargs):
+    host, _, port = host.partition(':') if host else (host, '', '')
+    return psycopg2.connect(host=host, port=port or None, dbname=DB_NAME, user=DB_USERNAME,
+                            password=DB_PASSWORD, **kwargs)
+
+def _healthy_replicas():
+    # Xoay vòng các replica còn khỏe, bắt đầu từ vị trí kế tiếp
+    now = time.monotonic()
+    with _replica_lock:
+        healthy = [h for h in DB_REPLICA_HOSTS if _replica_down_until.get(h, 0) <= now]
+    if not healthy:
+        return []
+    start = next(_replica_cycle) % len(healthy)
+    return healthy[start:] + healthy[:start]
+
+def _replica_lag_ok(host, conn):
+    now = time.monotonic()
+    with _replica_lock:
+        if _replica_lag_ok_until.get(host, 0) > now:
+            return True
+    cur = conn.cursor()
+    # Đã nhận và áp dụng hết WAL -> không trễ, dù giao dịch cuối đã cũ (primary rảnh).
+    # Chỉ đúng khi WAL receiver đang streaming: receiver mất kết nối thì receive_lsn
+    # đứng yên và cũng bằng replay_lsn. Cột status cần quyền pg_read_all_stats; thiếu
+    # quyền thì status là NULL và luôn tính trễ theo giao dịch cuối (an toàn).
+    cur.execute("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """)
+    lag = cur.fetchone()[0]
+    conn.rollback()
+    if lag is None or lag > REPLICA_MAX_LAG_SECONDS:
+        logger.warning(f"Replica {host} lagging ({lag}s), failing over")
+        return False
+    with _replica_lock:
+        _replica_lag_ok_until[host] = now + REPLICA_LAG_CHECK_SECONDS
+    return True
+
+def _mark_replica_down(host):
+    with _replica_lock:
+        _replica_down_until[host] = time.monotonic() + REPLICA_RETRY_SECONDS
+
+def pinned_to_primary():
+    # Client vừa ghi (trong request này hoặc theo cookie) -> đọc từ primary
+    if not has_request_context():
+        return False
+    if g.get('db_wrote'):
+        return True
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def mark_write():
+    # Gọi từ các route ghi: client này sẽ đọc từ primary trong READ_YOUR_WRITES_SECONDS
+    if has_request_context():
+        g.db_wrote = True
+
+def set_read_your_writes_cookie(response):
+    # after_request: ghi nhớ thời điểm ghi qua cookie để mọi worker đều biết
+    # (dùng cho cả định tuyến replica và để không trả 304 cũ ngay sau khi ghi)
+    if g.get('db_wrote'):
+        until = time.time() + READ_YOUR_WRITES_SECONDS
+        response.set_cookie(PRIMARY_COOKIE, f'{until:.3f}', max_age=int(READ_YOUR_WRITES_SECONDS) + 1,
+                            httponly=True, samesite='Lax')
+    return response
+
+def create_connection(readonly=False, pinned=None):
+    # readonly=True: truy vấn chỉ đọc, được phân tán sang read replica (nếu có).
+    # Mặc định (ghi, LISTEN/NOTIFY) luôn dùng primary.
+    # pinned: client phải đọc từ primary (read-your-writes); mặc định xác định từ
+    # request hiện tại. Luồng phụ không có request context nên phải truyền vào
+    # giá trị pinned_to_primary() đã lấy ở luồng request.
+    if pinned is None:
+        pinned = pinned_to_primary()
+    if readonly and DB_REPLICA_HOSTS and not pinned:
+        for host in _healthy_replicas():
+            conn = None
+            try:
+                conn = _connect(host, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+                conn.set_session(readonly=True)
+                if _replica_lag_ok(host, conn):
+                    return conn
+            except psycopg2.OperationalError as e:
+                logger.warning(f"Replica {host} unavailable, failing over: {e}")
+            _mark_replica_down(host)
+            if conn:
+                conn.close()
+    conn = _connect(DATABASE_HOST)
     return conn
 
 def fetch_data(cur):
@@ -1,5 +1,5 @@
-import requests
 import os
+from . import http_client
 
 API_HERE_MAP = os.getenv('API_MAP')
 # print(f"API_HERE_MAP: {API_HERE_MAP}")
@@ -10,7 +10,7 @@ def geocode_address(address):
         'apiKey': API_HERE_MAP,
     }
     print(url, params)
-    res = requests.get(url, params=params)
+    res = http_client.get(url, params=params)
     # res.raise_for_status()
     items = res.json().get('items')
     if not items:
@@ -0,0 +1,157 @@
+import gzip
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import make_response, request
+
+from . import change_feed
+from .db_utils import DB_REPLICA_HOSTS, REPLICA_STALE_SECONDS, create_connection, pinned_to_primary
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Chỉ nén body JSON đủ lớn; body nhỏ nén không đáng chi phí CPU
+COMPRESS_MIN_SIZE = 1024
+
+# Version cho từng bảng và từng loại cơ sở (amenity) lấy từ bảng data_versions,
+# do trigger tăng trong cùng transaction với thay đổi (xem change_feed.TRIGGER_SQL).
+# Mỗi worker chỉ sao chép giá trị đó: từ payload NOTIFY, và đọc lại cả bảng khi
+# change feed kết nối lại (RESYNC). Vì vậy ETag giống nhau ở mọi worker và request
+# có If-None-Match khớp được trả 304 mà không chạm DB.
+_lock = threading.Lock()
+_versions = {}
+_loaded = set()
+_changed_at = {}
+
+
+def _apply(table, entries):
+    # entries: [[amenity, version, modified_at], ...]; amenity '' là cả bảng.
+    # Chỉ nhận version lớn hơn: NOTIFY có thể đến sau khi đã RESYNC.
+    with _lock:
+        for amenity, number, modified_at in entries:
+            key = (table, amenity or '')
+            if number > _versions.get(key, (0, 0))[0]:
+                _versions[key] = (number, int(modified_at))
+        _changed_at[table] = time.monotonic()
+
+
+def load(table):
+    # Đọc lại toàn bộ version của bảng từ primary (luồng listener, không có request context)
+    conn = create_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT amenity, version, extract(epoch FROM modified_at)
+            FROM data_versions
+            WHERE table_name = %s
+        """, (table,))
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+    with _lock:
+        for key in [k for k in _versions if k[0] == table]:
+            del _versions[key]
+        for amenity, number, modified_at in rows:
+            _versions[(table, amenity)] = (number, int(modified_at))
+        _loaded.add(table)
+        _changed_at[table] = time.monotonic()
+
+
+def version(table, amenity=None):
+    with _lock:
+        table_version, table_modified = _versions.get((table, ''), (0, 0))
+        if amenity is None:
+            etag = f"t{table_version}"
+            last_modified = table_modified
+        else:
+            # Loại cơ sở chưa từng thay đổi: version 0, dùng thời điểm thay đổi của bảng
+            amenity_version, last_modified = _versions.get((table, amenity), (0, table_modified))
+            etag = f"a{amenity_version}"
+    return etag, datetime.fromtimestamp(last_modified, tz=timezone.utc)
+
+
+def _replica_may_lag(table):
+    # Ngay sau khi thay đổi, replica có thể chưa nhận kịp: không gắn token mới
+    # vào dữ liệu có thể còn cũ, trong suốt thời gian replica được phép trễ
+    if not DB_REPLICA_HOSTS:
+        return False
+    with _lock:
+        changed_at = _changed_at.get(table)
+    return changed_at is not None and time.monotonic() - changed_at < REPLICA_STALE_SECONDS
+
+
+def _on_access_health_change(event):
+    if event.get('op') in ('RESYNC', 'TRUNCATE'):
+        load('access_health')
+        return
+    _apply('access_health', event.get('versions') or [])
+
+
+change_feed.subscribe('access_health', _on_access_health_change)
+
+
+def conditional(table, amenity_of=None, required_args=()):
+    # Chỉ bật khi change feed đang chạy và đã đọc data_versions: nếu không, worker
+    # này không biết thay đổi mới và có thể trả 304 sai. Client vừa ghi cũng không
+    # nhận 304 cho tới khi hết cửa sổ read-your-writes (NOTIFY có thể chưa tới).
+    # required_args: tham số query bắt buộc của view; thiếu thì để view kiểm tra và
+    # trả lỗi (400/404) thay vì 304.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not change_feed.is_running() or table not in _loaded or pinned_to_primary():
+                return view(*args, **kwargs)
+            if not all(request.args.get(name) for name in required_args):
+                return view(*args, **kwargs)
+
+            amenity = amenity_of(**kwargs) if amenity_of else None
+            # Đọc version trước khi truy vấn: nếu dữ liệu đổi trong lúc truy vấn
+            # thì token cũ sẽ không khớp ở lần sau (an toàn).
+            etag, last_modified = version(table, amenity)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                ims = request.if_modified_since
+                not_modified = ims is not None and last_modified <= ims
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or _replica_may_lag(table):
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def compress_response(response):
+    if response.mimetype != 'application/json' or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accept['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
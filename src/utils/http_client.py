@@ -0,0 +1,20 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+# Pool kết nối dùng chung cho các proxy GeoServer / geocoding.
+# Với worker gevent, mỗi request upstream chỉ giữ một greenlet, nên pool có cùng
+# kích thước với worker_connections để một worker giữ được chừng ấy request đang
+# chờ. pool_block=False: nếu vẫn vượt quá pool thì mở kết nối tạm thay vì chờ
+# vô hạn (requests không truyền pool_timeout, HTTP_TIMEOUT không áp cho việc chờ pool).
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000)))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE, pool_block=False)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+def get(url, params=None, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return session.get(url, params=params, **kwargs)